@@ -3,13 +3,16 @@
 import paho.mqtt.client as mqtt
 import time
 import os
+import queue
 import sys
+import signal
 import logging
 import pytz
-import json
-import psycopg2  # For database functionality
+import orjson
+import psycopg  # For database functionality
+from psycopg_pool import ConnectionPool, PoolTimeout
 import ssl
-from datetime import datetime
+from datetime import datetime, timezone
 import threading
 
 # Force unbuffered output
@@ -18,11 +21,13 @@ sys.stdout.reconfigure(line_buffering=True)
 
 # Configure logging with timezone conversion
 class TimezoneFormatter(logging.Formatter):
+    _EASTERN = pytz.timezone("America/New_York")
+
     def formatTime(self, record, datefmt=None):
         # Convert UTC to Eastern time
-        utc_dt = datetime.utcfromtimestamp(record.created)
-        eastern_tz = pytz.timezone("America/New_York")
-        eastern_dt = utc_dt.replace(tzinfo=pytz.UTC).astimezone(eastern_tz)
+        eastern_dt = datetime.fromtimestamp(record.created, tz=timezone.utc).astimezone(
+            self._EASTERN
+        )
 
         if datefmt:
             return eastern_dt.strftime(datefmt)
@@ -35,7 +40,7 @@ formatter = TimezoneFormatter("%(asctime)s - %(levelname)s - %(message)s")
 handler.setFormatter(formatter)
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 logger.addHandler(handler)
 
 # Clear any existing handlers
@@ -43,169 +48,406 @@ logger.handlers = []
 logger.addHandler(handler)
 
 
-# Database connection
-def get_db_connection():
+# Database connection pool
+def get_db_pool():
     while True:
+        # Every writer thread holds one connection for as long as it runs
+        pool = ConnectionPool(
+            min_size=DB_WRITER_THREADS,
+            max_size=DB_WRITER_THREADS,
+            kwargs={
+                "dbname": os.getenv("POSTGRES_DB", "iotdb"),
+                "user": os.getenv("POSTGRES_USER", "iotuser"),
+                "password": os.getenv("POSTGRES_PASSWORD", "iotpass"),
+                "host": os.getenv("POSTGRES_HOST", "timescaledb"),
+                "port": os.getenv("POSTGRES_PORT", "5432"),
+                # Commits return without waiting for the WAL flush. A crash can
+                # lose the last fraction of a second of sensor readings, but
+                # never corrupts the table. Only this service's sessions are
+                # affected
+                "options": f"-c synchronous_commit={os.getenv('POSTGRES_SYNCHRONOUS_COMMIT', 'off')}",
+            },
+            open=False,
+        )
         try:
-            conn = psycopg2.connect(
-                dbname=os.getenv("POSTGRES_DB", "iotdb"),
-                user=os.getenv("POSTGRES_USER", "iotuser"),
-                password=os.getenv("POSTGRES_PASSWORD", "iotpass"),
-                host=os.getenv("POSTGRES_HOST", "timescaledb"),
-                port=os.getenv("POSTGRES_PORT", "5432"),
-            )
+            pool.open(wait=True)
             logger.info("Successfully connected to database")
-            return conn
-        except psycopg2.OperationalError as e:
+            return pool
+        except PoolTimeout as e:
+            pool.close()
             logger.error(f"Could not connect to database: {e}")
             logger.info("Retrying in 5 seconds...")
             time.sleep(5)
 
 
-def store_sensor_data(data):
-    """Stores the complete sensor data dictionary into the database."""
+# Column order and types (matching init-db.sql) used for every row
+# written to sensor_data
+SENSOR_SCHEMA = (
+    ("time", "timestamptz"),
+    ("device_id", "text"),
+    ("event_type", "text"),
+    ("temperature", "float8"),
+    ("humidity", "float8"),
+    ("pressure", "float8"),
+    ("temp_sensor_type", "text"),
+    ("motion", "text"),
+    ("switch", "text"),
+    ("version", "text"),
+    ("uptime", "text"),
+    ("wifi_rssi", "int4"),
+    ("uptime_seconds", "int4"),
+    ("fan_pwm", "int4"),
+    ("fans_active_level", "int4"),
+    ("sensor_type", "text"),
+)
+SENSOR_COLUMNS = tuple(name for name, _ in SENSOR_SCHEMA)
+INSERT_SQL = (
+    f"INSERT INTO sensor_data ({', '.join(SENSOR_COLUMNS)}) "
+    f"VALUES ({', '.join(['%s'] * len(SENSOR_COLUMNS))})"
+)
+COPY_SQL = f"COPY sensor_data ({', '.join(SENSOR_COLUMNS)}) FROM STDIN"
+# Inserts a whole page of rows sent as one typed array per column
+UNNEST_INSERT_SQL = (
+    f"INSERT INTO sensor_data ({', '.join(SENSOR_COLUMNS)}) "
+    f"SELECT * FROM unnest({', '.join(f'%s::{type_}[]' for _, type_ in SENSOR_SCHEMA)})"
+)
+
+# Converters for payload fields that must be stored as numbers or text.
+# motion, switch and sensor_type are forced to text so e.g. booleans are
+# stored the same way by COPY and INSERT
+COERCE = {
+    "temperature": float,
+    "humidity": float,
+    "pressure": float,
+    "motion": str,
+    "switch": str,
+    "wifi_rssi": int,
+    "uptime_seconds": int,
+    "fan_pwm": int,
+    "fans_active_level": int,
+    "sensor_type": str,
+}
+
+# Parsed (timestamp, data) messages are handed from the MQTT callback to
+# DB_WRITER_THREADS writer threads through message_queue. Each writer
+# converts them to rows and writes them in batches, either every
+# FLUSH_INTERVAL seconds or as soon as FLUSH_BATCH_SIZE messages are
+# waiting. Messages are dropped when more than MESSAGE_QUEUE_SIZE are waiting
+FLUSH_INTERVAL = int(os.getenv("DB_FLUSH_INTERVAL_MS", "500")) / 1000
+FLUSH_BATCH_SIZE = int(os.getenv("DB_FLUSH_BATCH_SIZE", "500"))
+DB_WRITER_THREADS = int(os.getenv("DB_WRITER_THREADS", "4"))
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+
+# Rows per unnest INSERT when a batch falls back to INSERT. The INSERTs
+# are prepared server-side on first use on each connection, so the
+# fallback only sends the parameters after that
+INSERT_PAGE_SIZE = 100
+
+message_queue = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+writer_stop = threading.Event()
+
+
+def coerce(data, key):
+    """Reads a payload field and converts it with its COERCE converter, returning None if it is missing or invalid."""
+    value = data.get(key)
+    convert = COERCE[key]
+    if value is None or type(value) is convert:
+        return value
     try:
-        # Create a copy of the data to avoid modifying the original
-        db_data = data.copy()
-
-        # Ensure event_type exists, provide default if not (optional safety)
-        db_data.setdefault("event_type", "unknown")
-
-        # Convert None to acceptable SQL values
-        for key in (
-            "temperature",
-            "humidity",
-            "pressure",
-            "wifi_rssi",
-            "uptime_seconds",
-            "fan_pwm",
-            "fans_active_level",
-        ):
-            if db_data.get(key) is not None:
-                try:
-                    if key in ("uptime_seconds", "fan_pwm", "fans_active_level"):
-                        db_data[key] = int(db_data[key])
-                    elif key == "wifi_rssi":
-                        db_data[key] = int(db_data[key])
-                    else:
-                        db_data[key] = float(db_data[key])
-                except Exception:
-                    logger.warning(
-                        f"Invalid value for {key}: {db_data[key]}, setting to None"
-                    )
-                    db_data[key] = None
-
-        # Ensure motion and switch are treated as text - explicitly convert to string if needed
-        if "motion" in db_data and db_data["motion"] is not None:
-            db_data["motion"] = str(db_data["motion"])
-
-        if "switch" in db_data and db_data["switch"] is not None:
-            db_data["switch"] = str(db_data["switch"])
-
-        # Handle sensor_type as text field
-        if "sensor_type" in db_data and db_data["sensor_type"] is not None:
-            db_data["sensor_type"] = str(db_data["sensor_type"])
-
-        # Rename timestamp to time for database schema compatibility
-        if "timestamp" in db_data:
-            db_data["time"] = db_data.pop("timestamp")
+        return convert(value)
+    except (TypeError, ValueError, OverflowError):
+        logger.warning(f"Invalid value for {key}: {value}, setting to None")
+        return None
 
-        # Debug output to check field values
-        logger.info(
-            f"Storing data with motion={db_data.get('motion')} switch={db_data.get('switch')} wifi_rssi={db_data.get('wifi_rssi')} fan_pwm={db_data.get('fan_pwm')} sensor_type={db_data.get('sensor_type')}"
+
+def build_sensor_row(timestamp, data):
+    """Builds a sensor_data row tuple from a sensor data dictionary."""
+    try:
+        get = data.get
+
+        # timestamp and device_id are required
+        if not timestamp:
+            raise KeyError("timestamp")
+        device_id = data["device_id"]
+
+        # Build the row in SENSOR_COLUMNS order, reading each field once
+        row = (
+            timestamp,
+            device_id,
+            get("event_type", "unknown"),
+            coerce(data, "temperature"),
+            coerce(data, "humidity"),
+            coerce(data, "pressure"),
+            get("temp_sensor_type"),
+            coerce(data, "motion"),
+            coerce(data, "switch"),
+            get("version"),
+            get("uptime"),
+            coerce(data, "wifi_rssi"),
+            coerce(data, "uptime_seconds"),
+            coerce(data, "fan_pwm"),
+            coerce(data, "fans_active_level"),
+            coerce(data, "sensor_type"),
         )
 
-        # Set default values for optional fields that might not be in the payload
-        db_data.setdefault("temp_sensor_type", None)
-        db_data.setdefault("sensor_type", None)
-
-        with db_conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO sensor_data (
-                    time, device_id, event_type, temperature, humidity, 
-                    pressure, temp_sensor_type, motion, switch, version, uptime,
-                    wifi_rssi, uptime_seconds, fan_pwm, fans_active_level, sensor_type
-                )
-                VALUES (
-                    %(time)s, %(device_id)s, %(event_type)s, %(temperature)s, %(humidity)s,
-                    %(pressure)s, %(temp_sensor_type)s, %(motion)s, %(switch)s, %(version)s, %(uptime)s,
-                    %(wifi_rssi)s, %(uptime_seconds)s, %(fan_pwm)s, %(fans_active_level)s, %(sensor_type)s
-                )
-            """,
-                db_data,
+        # Debug output to check field values
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Storing data with motion={row[7]} switch={row[8]} wifi_rssi={row[11]} fan_pwm={row[13]} sensor_type={row[15]}"
             )
-            db_conn.commit()
 
-        logger.info(
-            f"Stored {db_data['event_type']} data for device {db_data['device_id']}"
-        )
+        return row
 
     except KeyError as e:
         logger.error(f"Missing key in sensor data dictionary: {e}")
 
     except Exception as e:
         logger.error(f"Error storing sensor data: {e}")
-        logger.error(f"Data that caused error: {db_data}")
-        db_conn.rollback()
+        logger.error(f"Data that caused error: {data}")
+
+    return None
+
+
+def copy_rows(cur, rows):
+    """Streams rows into sensor_data with COPY FROM STDIN."""
+    with cur.copy(COPY_SQL) as copy:
+        for row in rows:
+            copy.write_row(row)
+
+
+def connection_lost(conn):
+    """Tells whether a database error left the connection unusable.
+
+    psycopg files some data errors (e.g. ProgramLimitExceeded for an
+    oversized index key) under OperationalError, so the exception class
+    alone can't tell a lost connection from rejected rows.
+    """
+    return conn.closed or conn.broken
+
+
+def insert_rows(conn, cur, rows):
+    """Inserts rows in pages under savepoints, dropping any rows the database rejects."""
+    stored = 0
+    for start in range(0, len(rows), INSERT_PAGE_SIZE):
+        page = rows[start : start + INSERT_PAGE_SIZE]
+        try:
+            # Send the page column-wise as one statement, the server unnests
+            # the arrays back into rows
+            columns = [list(column) for column in zip(*page)]
+            with conn.transaction():
+                cur.execute(UNNEST_INSERT_SQL, columns, prepare=True)
+            stored += len(page)
+            continue
+        except psycopg.Error:
+            if connection_lost(conn):
+                raise
+
+        # Something in this page was rejected, retry its rows one at a time
+        for row in page:
+            try:
+                with conn.transaction():
+                    cur.execute(INSERT_SQL, row, prepare=True)
+                stored += 1
+            except psycopg.Error as e:
+                if connection_lost(conn):
+                    raise
+                logger.error(f"Error storing sensor data: {e}")
+                logger.error(f"Row that caused error: {row}")
+    return stored
+
+
+def next_batch():
+    """Waits for the next message, then collects more until the batch is full or FLUSH_INTERVAL passes."""
+    try:
+        messages = [message_queue.get(timeout=FLUSH_INTERVAL)]
+    except queue.Empty:
+        return []
+
+    deadline = time.monotonic() + FLUSH_INTERVAL
+    while len(messages) < FLUSH_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            messages.append(message_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return messages
+
+
+def store_batch(conn, cur, rows):
+    """Writes a batch of rows in a single transaction."""
+    try:
+        with conn.transaction():
+            copy_rows(cur, rows)
+        return len(rows)
+    except psycopg.Error as e:
+        if connection_lost(conn):
+            raise
+        # A single bad row fails the whole COPY, so fall back to
+        # INSERTs that skip just the offending rows
+        logger.warning(f"COPY of {len(rows)} rows failed, retrying with INSERT: {e}")
+        with conn.transaction():
+            return insert_rows(conn, cur, rows)
+
+
+def db_writer():
+    """Drains message_queue into the database until told to stop and the queue is empty."""
+    # Each writer keeps one connection and cursor for as long as they work
+    conn = cur = None
+    while not (writer_stop.is_set() and message_queue.empty()):
+        rows = [
+            row
+            for row in (build_sensor_row(*message) for message in next_batch())
+            if row is not None
+        ]
+        if not rows:
+            continue
+
+        error = None
+        while True:
+            if error is not None and writer_stop.is_set():
+                # Don't hold up shutdown waiting for the database to come back
+                logger.error(
+                    f"Database unreachable at shutdown, dropping batch of {len(rows)} "
+                    f"rows and {message_queue.qsize()} queued messages: {error}"
+                )
+                return
+            fresh = conn is None
+            try:
+                if conn is None:
+                    conn = db_pool.getconn()
+                    cur = conn.cursor()
+                stored = store_batch(conn, cur, rows)
+                logger.debug(f"Stored batch of {stored} rows")
+                break
+            except psycopg.Error as e:
+                # getconn() failing (conn is None) or a lost connection means
+                # the database is unreachable; anything else is rejected data
+                if conn is not None and not connection_lost(conn):
+                    logger.error(f"Error storing batch of {len(rows)} rows: {e}")
+                    break
+                # Keep the batch and retry it on a fresh connection. The pool
+                # discards the connection if it turns out to be broken
+                error = e
+                if conn is not None:
+                    db_pool.putconn(conn)
+                    conn = cur = None
+                if not fresh:
+                    # The held connection may just have died while idle
+                    # (e.g. a database restart), try a new one straight away
+                    logger.warning(f"Database connection lost, reconnecting: {e}")
+                    continue
+                logger.error(f"Could not store batch of {len(rows)} rows: {e}")
+                logger.info("Retrying in 5 seconds...")
+                writer_stop.wait(5)
+            except Exception as e:
+                logger.error(f"Error storing batch of {len(rows)} rows: {e}")
+                break
+
+    if conn is not None:
+        cur.close()
+        db_pool.putconn(conn)
+
+
+def shutdown_db_writer():
+    """Flushes any queued rows and closes the connection pool."""
+    writer_stop.set()
+    deadline = time.monotonic() + 30
+    for thread in writer_threads:
+        thread.join(timeout=max(deadline - time.monotonic(), 0))
+    db_pool.close()
+
+
+if sys.version_info >= (3, 11):
+    # fromisoformat handles the 'Z' suffix for UTC natively
+    parse_timestamp = datetime.fromisoformat
+else:
+
+    def parse_timestamp(value):
+        """Parses an ISO format timestamp, accepting a 'Z' suffix for UTC."""
+        if value.endswith("Z"):
+            return datetime.fromisoformat(value[:-1]).replace(tzinfo=timezone.utc)
+        return datetime.fromisoformat(value)
+
+
+# Number of MQTT client connections. With more than one, the clients share
+# a single subscription so the broker spreads the messages across them
+MQTT_CLIENTS = int(os.getenv("MQTT_CLIENTS", "1"))
+MQTT_TOPIC = "iots6/#"
+MQTT_EVENT_PREFIX = b"MQTT event: "
+if MQTT_CLIENTS > 1:
+    MQTT_SUBSCRIPTION = f"$share/iot_service/{MQTT_TOPIC}"
+else:
+    MQTT_SUBSCRIPTION = MQTT_TOPIC
 
 
 def on_connect(client, userdata, flags, rc):
     logger.info(f"Connected with result code {rc}")
-    logger.info("Subscribing to iots6/#")  # Updated to match your topic
-    client.subscribe("iots6/#")
+    logger.info(f"Subscribing to {MQTT_SUBSCRIPTION}")  # Updated to match your topic
+    client.subscribe(MQTT_SUBSCRIPTION)
 
 
 def on_message(client, userdata, msg):
     try:
-        start_time = time.time()
-        message_text = msg.payload.decode()
-        logger.info(f"Received message on {msg.topic}: {message_text}")
-
-        # Check if the message has the prefix format
-        if "MQTT event:" in message_text:
-            # Extract just the JSON part
-            json_start = message_text.find("{")
-            if json_start != -1:
-                json_text = message_text[json_start:]
-                data = json.loads(json_text)
-            else:
-                raise ValueError("No JSON object found in message")
-        else:
-            # Regular JSON message
-            data = json.loads(message_text)
-
-        # Rest of function remains the same...
-        device_id = data.get("device_id", "unknown")
-
-        # Parse the ISO format timestamp (2025-04-21T17:21:47Z)
-        if "timestamp" in data and data["timestamp"]:
-            # Handle the timestamp format with 'Z' suffix for UTC
-            if data["timestamp"].endswith("Z"):
-                # Remove the Z and parse as UTC
-                ts_str = data["timestamp"][:-1]
-                dt = datetime.fromisoformat(ts_str)
-                data["timestamp"] = dt.replace(tzinfo=pytz.UTC)
-            else:
-                # Try to parse in standard ISO format
-                dt = datetime.fromisoformat(data["timestamp"])
-                # If no timezone info, assume UTC
-                if dt.tzinfo is None:
-                    data["timestamp"] = dt.replace(tzinfo=pytz.UTC)
-                else:
-                    data["timestamp"] = dt
-
-        # Store data in database
-        store_sensor_data(data)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            start_time = time.time()
+
+        # The payload stays bytes end-to-end (orjson and the prefix checks all
+        # work on bytes) and is only decoded for debug and error logging
+        payload = msg.payload
+        if debug:
+            logger.debug(
+                f"Received message on {msg.topic}: {payload.decode(errors='replace')}"
+            )
+
+        # Regular JSON messages start with the object itself. Otherwise strip
+        # the known "MQTT event: " prefix, and only scan for the JSON part if
+        # the message has some other prefix
+        if payload[:1] != b"{":
+            payload = payload.removeprefix(MQTT_EVENT_PREFIX)
+            if payload[:1] != b"{":
+                json_start = payload.find(b"{")
+                if json_start == -1:
+                    raise ValueError("No JSON object found in message")
+                payload = payload[json_start:]
+        data = orjson.loads(payload)
+
+        # Parse the ISO format timestamp (2025-04-21T17:21:47Z) into a
+        # normalised ISO string that COPY can take verbatim
+        timestamp = data.get("timestamp")
+        if timestamp:
+            dt = parse_timestamp(timestamp)
+            # If no timezone info, assume UTC
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            timestamp = dt.isoformat()
+
+        # Hand the message to the database writers without blocking the
+        # MQTT network loop
+        try:
+            message_queue.put_nowait((timestamp, data))
+        except queue.Full:
+            logger.warning(
+                f"Message queue full, dropping message from device {data.get('device_id', 'unknown')}"
+            )
 
         # Log processing time
-        processing_time = time.time() - start_time
-        logger.debug(f"Message processing time: {processing_time} seconds")
+        if debug:
+            processing_time = time.time() - start_time
+            logger.debug(f"Message processing time: {processing_time} seconds")
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Error decoding JSON: {e}")
+        logger.error(
+            f"Payload that caused error: {msg.payload.decode(errors='replace')}"
+        )
     except Exception as e:
         logger.error(f"Error processing message: {e}")
+        logger.error(
+            f"Payload that caused error: {msg.payload.decode(errors='replace')}"
+        )
 
 
 def on_subscribe(client, userdata, mid, granted_qos):
@@ -217,23 +459,40 @@ def on_disconnect(client, userdata, rc):
 
 
 # Database connection initialization
-db_conn = get_db_connection()
-
-# Create client instance with explicit API version
-client = mqtt.Client(
-    client_id="",
-    clean_session=True,
-    userdata=None,
-    protocol=mqtt.MQTTv311,
-    transport="tcp",
-    reconnect_on_failure=True,
-)
-
-# Assign callback functions
-client.on_connect = on_connect
-client.on_message = on_message
-client.on_subscribe = on_subscribe
-client.on_disconnect = on_disconnect
+db_pool = get_db_pool()
+
+# Start the background batch writers
+writer_threads = [
+    threading.Thread(target=db_writer, name=f"db-writer-{i}", daemon=True)
+    for i in range(DB_WRITER_THREADS)
+]
+for thread in writer_threads:
+    thread.start()
+
+
+def create_mqtt_client():
+    # Create client instance with explicit API version
+    client = mqtt.Client(
+        client_id="",
+        clean_session=True,
+        userdata=None,
+        protocol=mqtt.MQTTv311,
+        transport="tcp",
+        reconnect_on_failure=True,
+    )
+
+    # Assign callback functions
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_subscribe = on_subscribe
+    client.on_disconnect = on_disconnect
+    return client
+
+
+# Stop cleanly on docker stop / Kubernetes pod termination as well as Ctrl+C
+shutdown_event = threading.Event()
+signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_event.set())
+signal.signal(signal.SIGINT, lambda signum, frame: shutdown_event.set())
 
 # Get broker address from environment variable, default to localhost
 broker_address = os.getenv("MQTT_BROKER", "localhost")
@@ -241,13 +500,18 @@ broker_port = int(os.getenv("MQTT_PORT", "1883"))
 
 logger.info(f"Connecting to broker at {broker_address}:{broker_port}...")
 
+# Each client runs its network loop on its own paho thread
+clients = [create_mqtt_client() for _ in range(MQTT_CLIENTS)]
 try:
-    client.connect(broker_address, broker_port, 60)
-    client.loop_forever()
-except KeyboardInterrupt:
+    for client in clients:
+        client.connect(broker_address, broker_port, 60)
+        client.loop_start()
+    shutdown_event.wait()
     logger.info("Shutting down...")
-    client.disconnect()
-    db_conn.close()
 except Exception as e:
     logger.error(f"Error occurred: {e}")
-    db_conn.close()
\ No newline at end of file
+finally:
+    for client in clients:
+        client.disconnect()
+        client.loop_stop()
+    shutdown_db_writer()